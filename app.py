@@ -1,16 +1,34 @@
 import os
 import json
+import codecs
+import logging
 import threading
 import traceback
 import time
+import itertools
 import random
+import sqlite3
 import string
 from datetime import datetime
 from collections import deque
-from flask import Flask, request, render_template_string, redirect, url_for, jsonify, send_file
+from typing import Any, List, Optional, Union
+try:
+    import orjson
+except ImportError:  # PyPy 等没有 orjson wheel 的解释器，回退标准库 json
+    orjson = None
+try:
+    import msgspec
+except ImportError:  # 同上，缺失时 /api/tick 回退标准库 json
+    msgspec = None
+from flask import Flask, Response, request, redirect, url_for, jsonify, send_file
 
 app = Flask(__name__)
 
+# 生产环境默认 INFO；需要看每次下单/轮询明细时设 LOG_LEVEL=DEBUG
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+                    format="%(asctime)s %(levelname)s %(message)s")
+log = logging.getLogger(__name__)
+
 # ==================== 全局数据结构 ====================
 MAX_HISTORY = 50
 
@@ -19,22 +37,27 @@ history_positions = deque(maxlen=MAX_HISTORY)
 history_report = deque(maxlen=MAX_HISTORY)
 history_poll = deque(maxlen=MAX_HISTORY)
 history_echo = deque(maxlen=MAX_HISTORY)
+# 不加锁：deque.appendleft / list(deque) 在 GIL 下是原子的；
+# 遍历一律先 list() 快照，避免并发写入时 "deque mutated during iteration"
 
-history_lock = threading.RLock()
-
-commands = []
-commands_lock = threading.RLock()
-cmd_counter = 0
+# 不加锁：append / popleft / remove 在 GIL 下都是原子的
+commands = deque()
+_next_cmd_seq = itertools.count(1).__next__
 
 paused = False
 pause_lock = threading.RLock()
 
 def generate_unique_cmd_id():
-    global cmd_counter
     ms = int(time.time() * 1000)
-    with commands_lock:
-        cmd_counter += 1
-        return f"{ms}_{cmd_counter}"
+    return f"{ms}_{_next_cmd_seq()}"
+
+def take_command(cmd):
+    """从队列摘除 cmd；已被其他线程取走则返回 False"""
+    try:
+        commands.remove(cmd)
+        return True
+    except ValueError:
+        return False
 
 # ==================== 产品规则表 ====================
 PRODUCT_SPECS = {
@@ -192,7 +215,7 @@ def cache_tick_quote(raw_symbol, bid, ask, spread=None, ts=None):
         latest_quote_cache[norm] = {
             "bid": b, "ask": a, "symbol": norm,
             "spread": spread, "ts": ts,
-            "received_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "received_at": now_str(),
         }
 
 def ingest_quote_from_parsed(p):
@@ -245,25 +268,23 @@ def update_kline(raw_symbol, bid, ask, tick_ts_ms):
 # ==================== 命令过期清理 ====================
 def cleanup_expired_commands():
     now = int(time.time())
-    with commands_lock:
-        expired = [c for c in commands if now - c.get("created_at", 0) >= c.get("ttl_sec", 600)]
-        commands[:] = [c for c in commands if now - c.get("created_at", 0) < c.get("ttl_sec", 600)]
-        if expired:
-            print(f"[CLEANUP] 清理了 {len(expired)} 条过期命令")
-            with history_lock:
-                for cmd in expired:
-                    record = {
-                        "received_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "ip": "127.0.0.1", "method": "INTERNAL", "path": "cleanup",
-                        "category": "report", "headers": {}, "body_raw": "{}",
-                        "parsed": {
-                            "cmd_id": cmd.get("id"), "ok": False, "ticket": 0,
-                            "error": "ORDER_EXPIRED",
-                            "message": f"订单超时未执行 (TTL {cmd.get('ttl_sec', 600)}s)",
-                            "exec_ms": 0, "desc": "ORDER_EXPIRED"
-                        }
-                    }
-                    history_report.appendleft(record)
+    expired = [c for c in list(commands)
+               if now - c.get("created_at", 0) >= c.get("ttl_sec", 600) and take_command(c)]
+    if expired:
+        log.info("[CLEANUP] 清理了 %d 条过期命令", len(expired))
+        for cmd in expired:
+            record = {
+                "received_at": now_str(),
+                "ip": "127.0.0.1", "method": "INTERNAL", "path": "cleanup",
+                "category": "report", "headers": {}, "body_raw_preview": "{}",
+                "parsed": {
+                    "cmd_id": cmd.get("id"), "ok": False, "ticket": 0,
+                    "error": "ORDER_EXPIRED",
+                    "message": f"订单超时未执行 (TTL {cmd.get('ttl_sec', 600)}s)",
+                    "exec_ms": 0, "desc": "ORDER_EXPIRED"
+                }
+            }
+            push_history("report", record)
 
 def cleanup_scheduler():
     while True:
@@ -278,6 +299,18 @@ def is_restricted_time():
     return False
 
 # ==================== 工具函数 ====================
+_now_str_cache = (0, "")
+
+def now_str():
+    """本地时间 %Y-%m-%d %H:%M:%S；同一秒内复用已格式化的字符串"""
+    global _now_str_cache
+    sec = int(time.time())
+    cached = _now_str_cache
+    if cached[0] != sec:
+        cached = (sec, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sec)))
+        _now_str_cache = cached
+    return cached[1]
+
 def generate_nonce():
     return ''.join(random.choices(string.ascii_letters + string.digits, k=16))
 
@@ -295,29 +328,59 @@ def norm_volume(x):
     except (ValueError, TypeError):
         return 0
 
+def json_body(payload):
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+def json_bytes_response(body, status=200):
+    # 已编码好的 bytes 直接交给 Werkzeug，不再经过 jsonify / 迭代器包装
+    return Response(body, status=status, mimetype="application/json", direct_passthrough=True)
+
+def orjson_response(payload, status=200):
+    return json_bytes_response(json_body(payload), status)
+
 def get_client_ip():
     return request.headers.get('X-Real-Ip') or request.headers.get('X-Forwarded-For', request.remote_addr)
 
-def try_parse_json(raw_body: str):
-    cleaned = (raw_body or "").strip()
+STORED_HEADERS = ("User-Agent", "X-Real-Ip", "X-Forwarded-For", "Content-Type", "Content-Length")
+
+def get_stored_headers():
+    """历史记录只保留排查用的少数请求头，不整份拷贝 cookie 等大头"""
+    headers = request.headers
+    return {k: headers[k] for k in STORED_HEADERS if k in headers}
+
+_json_decoder = json.JSONDecoder()
+
+def try_parse_json(raw_bytes: bytes):
+    if not raw_bytes:
+        return None, None, None, None
+    # orjson 直接解析 bytes，省掉整段解码成 str 再 strip 的两次拷贝
+    if orjson is not None:
+        try:
+            return orjson.loads(raw_bytes), None, None, None
+        except orjson.JSONDecodeError:
+            pass
+    cleaned = raw_bytes.decode("utf-8", "replace").strip()
     if not cleaned:
         return None, None, None, None
     parsed_json = None
     parse_error = None
     parse_error_detail = None
     remaining_data = None
+    # orjson 不接受尾随数据，回退 raw_decode 以提取 remaining_data
     try:
-        decoder = json.JSONDecoder()
-        parsed_json, idx = decoder.raw_decode(cleaned)
+        parsed_json, idx = _json_decoder.raw_decode(cleaned)
         remaining = cleaned[idx:].strip()
         if remaining:
             remaining_data = remaining[:200]
     except json.JSONDecodeError as e:
         parse_error = str(e)
-        parse_error_detail = traceback.format_exc()
+        parse_error_detail = traceback.format_exc() if app.debug else \
+            f"{type(e).__name__} at pos={e.pos} line={e.lineno} col={e.colno}"
     except Exception as e:
         parse_error = f"未知异常: {str(e)}"
-        parse_error_detail = traceback.format_exc()
+        parse_error_detail = traceback.format_exc() if app.debug else repr(e)
     return parsed_json, parse_error, parse_error_detail, remaining_data
 
 def detect_category(path: str, parsed_json: dict):
@@ -328,80 +391,67 @@ def detect_category(path: str, parsed_json: dict):
     if path.endswith("/web/api/mt4/commands"):  return "poll"
     return "other"
 
-def store_mt4_data(raw_body, client_ip, headers_dict):
-    parsed_json, parse_error, parse_error_detail, remaining_data = try_parse_json(raw_body)
+def body_preview(raw_bytes, limit=500):
+    # 只解码前 limit 字节；增量解码器不输出被截断的尾部多字节字符，避免出现 U+FFFD
+    return codecs.getincrementaldecoder("utf-8")("replace").decode((raw_bytes or b"")[:limit])
+
+def store_mt4_data(raw_bytes, client_ip, headers_dict):
+    parsed_json, parse_error, parse_error_detail, remaining_data = try_parse_json(raw_bytes)
     category = detect_category(request.path, parsed_json if isinstance(parsed_json, dict) else None)
 
     record = {
-        "received_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "received_at": now_str(),
         "ip": client_ip, "method": request.method, "path": request.path,
         "category": category, "headers": headers_dict,
-        "body_raw": raw_body, "parsed": parsed_json,
+        "body_raw_preview": body_preview(raw_bytes),
+        "parsed": parsed_json,
         "parse_error": parse_error, "parse_error_detail": parse_error_detail,
         "remaining_data": remaining_data,
-        "account":          parsed_json.get("account")          if isinstance(parsed_json, dict) else None,
-        "server":           parsed_json.get("server")           if isinstance(parsed_json, dict) else None,
-        "balance":          parsed_json.get("balance")          if isinstance(parsed_json, dict) else None,
-        "equity":           parsed_json.get("equity")           if isinstance(parsed_json, dict) else None,
-        "floating_pnl":     parsed_json.get("floating_pnl")     if isinstance(parsed_json, dict) else None,
-        "leverage_used":    parsed_json.get("leverage_used")    if isinstance(parsed_json, dict) else None,
-        "risk_flags":       parsed_json.get("risk_flags")       if isinstance(parsed_json, dict) else None,
-        "exposure_notional":parsed_json.get("exposure_notional")if isinstance(parsed_json, dict) else None,
-        "positions":        parsed_json.get("positions")        if isinstance(parsed_json, dict) else None,
     }
 
     if isinstance(parsed_json, dict) and category in ("report", "other"):
         ingest_quote_from_parsed(parsed_json)
 
-    with history_lock:
-        if category == "status":
-            history_status.appendleft(record)
-        elif category == "positions":
-            history_positions.appendleft(record)
-        elif category == "report":
-            history_report.appendleft(record)
-            if record.get("parsed"):
-                parsed = record["parsed"]
-                desc = parsed.get("desc", "")
-                cmd_id_str = str(parsed.get("cmd_id", ""))
-                if desc != "QUOTE_DATA" and record.get("method") != "INTERNAL" \
-                        and parsed.get("cmd_id") and not cmd_id_str.startswith("q_"):
-                    msg_extra = {}
-                    try:
-                        raw_msg = parsed.get("message", "")
-                        if isinstance(raw_msg, str) and raw_msg.startswith("{"):
-                            msg_extra = json.loads(raw_msg)
-                    except Exception:
-                        pass
-                    def _pick(*keys):
-                        for k in keys:
-                            v = parsed.get(k)
-                            if v is not None: return v
-                            v = msg_extra.get(k)
-                            if v is not None: return v
-                        return None
-                    trade_record = {
-                        "received_at": record.get("received_at"),
-                        "cmd_id":      parsed.get("cmd_id"),
-                        "ok":          parsed.get("ok"),
-                        "ticket":      _pick("ticket"),
-                        "error":       _pick("error"),
-                        "message":     parsed.get("message"),
-                        "exec_ms":     _pick("exec_ms"),
-                        "symbol":      _pick("symbol"),
-                        "side":        _pick("side", "type", "action"),
-                        "volume":      _pick("volume", "lots"),
-                        "open_price":  _pick("open_price", "open"),
-                        "close_price": _pick("close_price", "price", "close"),
-                        "open_time":   _pick("open_time"),
-                        "profit":      _pick("profit", "pnl"),
-                        "desc":        parsed.get("desc", ""),
-                    }
-                    save_history_trade(trade_record)
-        elif category == "poll":
-            history_poll.appendleft(record)
-        elif category == "echo":
-            history_echo.appendleft(record)
+    push_history(category, record)
+    if category == "report":
+        if record.get("parsed"):
+            parsed = record["parsed"]
+            desc = parsed.get("desc", "")
+            cmd_id_str = str(parsed.get("cmd_id", ""))
+            if desc != "QUOTE_DATA" and record.get("method") != "INTERNAL" \
+                    and parsed.get("cmd_id") and not cmd_id_str.startswith("q_"):
+                msg_extra = {}
+                try:
+                    raw_msg = parsed.get("message", "")
+                    if isinstance(raw_msg, str) and raw_msg.startswith("{"):
+                        msg_extra = json.loads(raw_msg)
+                except Exception:
+                    pass
+                def _pick(*keys):
+                    for k in keys:
+                        v = parsed.get(k)
+                        if v is not None: return v
+                        v = msg_extra.get(k)
+                        if v is not None: return v
+                    return None
+                trade_record = {
+                    "received_at": record.get("received_at"),
+                    "cmd_id":      parsed.get("cmd_id"),
+                    "ok":          parsed.get("ok"),
+                    "ticket":      _pick("ticket"),
+                    "error":       _pick("error"),
+                    "message":     parsed.get("message"),
+                    "exec_ms":     _pick("exec_ms"),
+                    "symbol":      _pick("symbol"),
+                    "side":        _pick("side", "type", "action"),
+                    "volume":      _pick("volume", "lots"),
+                    "open_price":  _pick("open_price", "open"),
+                    "close_price": _pick("close_price", "price", "close"),
+                    "open_time":   _pick("open_time"),
+                    "profit":      _pick("profit", "pnl"),
+                    "desc":        parsed.get("desc", ""),
+                }
+                save_history_trade(trade_record)
 
     return parsed_json, record
 
@@ -459,8 +509,95 @@ def update_risk_after_trade(trade_profit, open_price, close_price, side):
 # ==================== 数据持久化 ====================
 DAILY_STATS_FILE    = "daily_stats.json"
 HISTORY_TRADES_FILE = "history_trades.json"
+HISTORY_DB_FILE     = "history.db"
 daily_stats_lock    = threading.RLock()
 history_file_lock   = threading.RLock()
+history_db_lock     = threading.Lock()
+
+HISTORY_BY_CATEGORY = {
+    "status": history_status, "positions": history_positions, "report": history_report,
+    "poll": history_poll, "echo": history_echo,
+}
+# status / positions 是账户实时状态，重启后必须等 EA 重新上报，不能用旧值
+# （旧净值会被 get_day_start_equity 当作当日起始净值，进而误触发熔断）；
+# poll / echo 是 EA 高频轮询，重启后无价值，不值得在请求线程上做 SQLite 写入
+PERSISTED_CATEGORIES = ("report",)
+
+def open_history_db():
+    """WAL 模式的 SQLite 环形存储，每个分类最多保留 MAX_HISTORY 行"""
+    try:
+        conn = sqlite3.connect(HISTORY_DB_FILE, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS history ("
+                     "id INTEGER PRIMARY KEY, category TEXT NOT NULL, "
+                     "received_at TEXT, record TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_category ON history(category, id)")
+        return conn
+    except Exception as e:
+        log.error("Open history db failed: %s", e)
+        return None
+
+history_db = open_history_db()
+
+def persist_history_record(category, record):
+    if history_db is None: return
+    try:
+        if orjson is not None:
+            payload = orjson.dumps(record, default=str).decode("utf-8")
+        else:
+            payload = json.dumps(record, ensure_ascii=False, default=str)
+        with history_db_lock:
+            history_db.execute("BEGIN")
+            try:
+                history_db.execute("INSERT INTO history (category, received_at, record) VALUES (?, ?, ?)",
+                                   (category, record.get("received_at"), payload))
+                history_db.execute("DELETE FROM history WHERE category = ? AND id <= "
+                                   "(SELECT id FROM history WHERE category = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                                   (category, category, MAX_HISTORY))
+                history_db.execute("COMMIT")
+            except Exception:
+                history_db.execute("ROLLBACK")
+                raise
+    except Exception as e:
+        log.error("Persist history record failed: %s", e)
+
+history_version = 0
+_next_history_version = itertools.count(1).__next__
+
+def is_quote_record(record):
+    """行情类记录（/api/tick、QUOTE_DATA、带 bid/ask 的上报）：重启后已过期，不落盘"""
+    parsed = record.get("parsed")
+    if not isinstance(parsed, dict): return False
+    if parsed.get("desc") == "QUOTE_DATA": return True
+    b, a = _bid_ask_from_dict(parsed)
+    return b is not None and a is not None
+
+def push_history(category, record):
+    global history_version
+    dq = HISTORY_BY_CATEGORY.get(category)
+    if dq is not None: dq.appendleft(record)
+    # 先写入再递增版本，读者看到新版本时一定能看到新记录；
+    # "other" 分类不入 deque，但可能刷新了报价缓存，同样要递增
+    history_version = _next_history_version()
+    if category in PERSISTED_CATEGORIES and not is_quote_record(record):
+        persist_history_record(category, record)
+
+def load_history_from_db():
+    """启动时从 SQLite 回填 PERSISTED_CATEGORIES 对应的内存 deque"""
+    if history_db is None: return
+    try:
+        with history_db_lock:
+            for category in PERSISTED_CATEGORIES:
+                dq = HISTORY_BY_CATEGORY[category]
+                rows = history_db.execute("SELECT record FROM history WHERE category = ? ORDER BY id DESC LIMIT ?",
+                                          (category, MAX_HISTORY)).fetchall()
+                for (payload,) in rows:
+                    dq.append(json.loads(payload))
+    except Exception as e:
+        log.error("Load history db failed: %s", e)
+
+load_history_from_db()
 
 def load_daily_stats():
     if not os.path.exists(DAILY_STATS_FILE): return {}
@@ -473,7 +610,7 @@ def save_daily_stats(stats):
         with open(DAILY_STATS_FILE, "w", encoding="utf-8") as f:
             json.dump(stats, f, ensure_ascii=False, indent=2)
     except Exception as e:
-        print(f"[ERR] Save daily stats failed: {e}")
+        log.error("Save daily stats failed: %s", e)
 
 def load_history_trades():
     if not os.path.exists(HISTORY_TRADES_FILE): return []
@@ -496,7 +633,7 @@ def save_history_trade(trade_record):
             with open(HISTORY_TRADES_FILE, "w", encoding="utf-8") as f:
                 json.dump(current_history, f, ensure_ascii=False, indent=2)
         except Exception as e:
-            print(f"[ERR] Save history trade failed: {e}")
+            log.error("Save history trade failed: %s", e)
 
 def delete_history_trade_by_id(cmd_id):
     with history_file_lock:
@@ -508,7 +645,7 @@ def delete_history_trade_by_id(cmd_id):
                     json.dump(new_history, f, ensure_ascii=False, indent=2)
                 return True
             except Exception as e:
-                print(f"[ERR] Delete history trade failed: {e}")
+                log.error("Delete history trade failed: %s", e)
         return False
 
 def update_daily_stats_from_record(record):
@@ -558,15 +695,14 @@ def get_latest_price(symbol):
         b, a = _to_float(cq.get("bid")), _to_float(cq.get("ask"))
         if b and a:
             return (b + a) / 2.0
-    with history_lock:
-        for record in history_report:
-            parsed = record.get("parsed")
-            if parsed and parsed.get("desc") == "QUOTE_DATA" and parsed.get("symbol") == symbol:
-                try:
-                    msg = json.loads(parsed.get("message", "{}"))
-                    if "bid" in msg:
-                        return (msg["bid"] + msg["ask"]) / 2
-                except: pass
+    for record in list(history_report):
+        parsed = record.get("parsed")
+        if parsed and parsed.get("desc") == "QUOTE_DATA" and parsed.get("symbol") == symbol:
+            try:
+                msg = json.loads(parsed.get("message", "{}"))
+                if "bid" in msg:
+                    return (msg["bid"] + msg["ask"]) / 2
+            except: pass
     return None
 
 def get_rate_to_usd(currency):
@@ -675,7 +811,7 @@ def extract_latest_details_from_status(record, positions=None):
     if not record: return None
     base_info = {
         "received_at": record.get("received_at"), "ip": record.get("ip"),
-        "body_raw_preview": (record.get("body_raw","")[:500]),
+        "body_raw_preview": record.get("body_raw_preview", ""),
         "remaining_data": record.get("remaining_data"),
     }
     if record.get("parse_error"):
@@ -683,7 +819,7 @@ def extract_latest_details_from_status(record, positions=None):
     parsed = record.get("parsed")
     if not isinstance(parsed, dict):
         return {**base_info, "error": "JSON 解析失败或不是对象"}
-    if positions is None: positions = record.get("positions")
+    if positions is None: positions = parsed.get("positions")
     parsed = auto_fill_status(parsed, positions)
     metrics = parsed.get("metrics", {})
     global risk_state
@@ -733,9 +869,24 @@ def api_resume():
 def api_status():
     with pause_lock: return jsonify({"paused": paused})
 
+LATEST_STATUS_TTL   = 1.0
+latest_status_cache = {}
+
 @app.route("/api/latest_status", methods=["GET"])
 def api_latest_status():
+    # 多个页面同时轮询：history 未变且未过 TTL 时直接复用序列化结果；
+    # TTL 兜底风控冷静期、锁仓等不经过 history 的状态变化
     symbol_filter = request.args.get("symbol","").upper().strip()
+    version = history_version; now = time.time()
+    cached = latest_status_cache.get(symbol_filter)
+    if cached and cached[0] == version and cached[1] > now:
+        return json_bytes_response(cached[2])
+    body = json_body(build_latest_status(symbol_filter) or {})
+    if len(latest_status_cache) > 64: latest_status_cache.clear()
+    latest_status_cache[symbol_filter] = (version, now + LATEST_STATUS_TTL, body)
+    return json_bytes_response(body)
+
+def build_latest_status(symbol_filter):
     norm_filter   = normalize_symbol(symbol_filter) if symbol_filter else ""
     detail = None; latest_quote = None; current_price = 0
     if norm_filter:
@@ -744,52 +895,52 @@ def api_latest_status():
         if cq:
             latest_quote  = dict(cq)
             current_price = _to_float(cq.get("bid")) or 0
-    with history_lock:
-        latest_status_record    = history_status[0]    if history_status    else None
-        latest_positions_record = history_positions[0] if history_positions else None
-        if not latest_quote:
-            for record in history_report:
-                parsed = record.get("parsed")
-                if not isinstance(parsed, dict): continue
-                if parsed.get("desc") == "QUOTE_DATA":
-                    rs = parsed.get("symbol","")
-                    if norm_filter and normalize_symbol(rs) != norm_filter: continue
-                    qd = _message_to_quote_dict(parsed)
-                    if not qd:
-                        try: qd = json.loads(parsed.get("message") or "{}")
-                        except: qd = None
-                    if isinstance(qd, dict):
-                        b, a = _bid_ask_from_dict(qd)
-                        if b is not None and a is not None:
-                            latest_quote  = {"bid":b,"ask":a,"symbol":normalize_symbol(rs) or rs,
-                                             "spread":parsed.get("spread"),"ts":parsed.get("ts")}
-                            current_price = b; break
-        if not latest_quote:
-            for record in history_report:
-                parsed = record.get("parsed")
-                if not isinstance(parsed, dict): continue
+    latest_status_record    = history_status[0]    if history_status    else None
+    latest_positions_record = history_positions[0] if history_positions else None
+    # deque 已是 appendleft 的新→旧顺序，直接遍历；两轮扫描共用同一份快照
+    reports = list(history_report) if not latest_quote else ()
+    if not latest_quote:
+        for record in reports:
+            parsed = record.get("parsed")
+            if not isinstance(parsed, dict): continue
+            if parsed.get("desc") == "QUOTE_DATA":
                 rs = parsed.get("symbol","")
                 if norm_filter and normalize_symbol(rs) != norm_filter: continue
-                b, a = _bid_ask_from_dict(parsed)
-                if b is not None and a is not None:
-                    latest_quote = {"bid":b,"ask":a,"symbol":normalize_symbol(rs) or rs,
-                                    "spread":parsed.get("spread"),"ts":parsed.get("ts")}
-                    current_price = b; break
-        positions_data = None
-        if latest_positions_record:
-            positions_data = latest_positions_record.get("parsed",{}).get("positions",[])
-        detail = extract_latest_details_from_status(latest_status_record, positions_data)
+                qd = _message_to_quote_dict(parsed)
+                if not qd:
+                    try: qd = json.loads(parsed.get("message") or "{}")
+                    except: qd = None
+                if isinstance(qd, dict):
+                    b, a = _bid_ask_from_dict(qd)
+                    if b is not None and a is not None:
+                        latest_quote  = {"bid":b,"ask":a,"symbol":normalize_symbol(rs) or rs,
+                                         "spread":parsed.get("spread"),"ts":parsed.get("ts")}
+                        current_price = b; break
+    if not latest_quote:
+        for record in reports:
+            parsed = record.get("parsed")
+            if not isinstance(parsed, dict): continue
+            rs = parsed.get("symbol","")
+            if norm_filter and normalize_symbol(rs) != norm_filter: continue
+            b, a = _bid_ask_from_dict(parsed)
+            if b is not None and a is not None:
+                latest_quote = {"bid":b,"ask":a,"symbol":normalize_symbol(rs) or rs,
+                                "spread":parsed.get("spread"),"ts":parsed.get("ts")}
+                current_price = b; break
+    positions_data = None
+    if latest_positions_record:
+        positions_data = latest_positions_record.get("parsed",{}).get("positions",[])
+    detail = extract_latest_details_from_status(latest_status_record, positions_data)
     if detail:
         if latest_quote: detail["latest_quote"] = latest_quote
         if norm_filter and current_price > 0:
             detail["symbol_rules"] = calc_lot_info(norm_filter, current_price, 1.0)
-        return jsonify(detail)
-    return jsonify({})
+    return detail
 
 @app.route("/api/history_trades", methods=["GET"])
 def api_history_trades():
     limit = request.args.get("limit", 20, type=int)
-    return jsonify({"trades": load_history_trades()[:limit]})
+    return orjson_response({"trades": load_history_trades()[:limit]})
 
 @app.route("/api/history_trades/delete", methods=["POST"])
 def delete_history_trade_api():
@@ -806,7 +957,8 @@ def delete_history_trade_api():
 @app.route("/api/all_quotes", methods=["GET"])
 def api_all_quotes():
     with quote_cache_lock:
-        return jsonify({sym: dict(q) for sym, q in latest_quote_cache.items()})
+        quotes = {sym: dict(q) for sym, q in latest_quote_cache.items()}
+    return orjson_response(quotes)
 
 @app.route("/api/kline", methods=["GET"])
 def api_kline():
@@ -817,7 +969,7 @@ def api_kline():
     limit  = min(request.args.get("limit", KLINE_MAX[tf], type=int), KLINE_MAX[tf])
     with _get_kline_lock(norm):
         bars = list(kline_data.get(norm,{}).get(tf,[]))
-    return jsonify({"symbol":norm,"tf":tf,"bars":bars[-limit:]})
+    return orjson_response({"symbol":norm,"tf":tf,"bars":bars[-limit:]})
 
 # ==================== 主页 HTML ====================
 HTML_TEMPLATE = r"""<!doctype html>
@@ -1712,7 +1864,8 @@ setInterval(kFetch,1500);
 
 @app.route("/")
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    # 页面是纯静态壳，数据由前端轮询 /api/* 获取，无需经过 Jinja
+    return HTML_TEMPLATE
 
 # ==================== API v1 ====================
 
@@ -1725,7 +1878,7 @@ def submit_order_v1():
     if not data:
         return jsonify({"success": False, "message": "请求体为空或非 JSON"}), 400
 
-    print(f"[ORDER] Recv: {json.dumps(data)}")
+    log.debug("[ORDER] Recv: %s", data)
 
     symbol      = norm_symbol(data.get('symbol', ''))
     side_raw    = data.get('side', '')
@@ -1734,12 +1887,11 @@ def submit_order_v1():
     # 风控检查（不拦截 QUOTE / CLOSE）
     if side_raw not in ('QUOTE', 'CLOSE') and cmd_type_raw != 'quote':
         account = current_equity = day_start_equity = None
-        with history_lock:
-            if history_status and isinstance(history_status[0].get("parsed"), dict):
-                p = history_status[0]["parsed"]
-                account = norm_str(p.get("account"))
-                current_equity   = p.get("equity", 0)
-                day_start_equity = p.get("day_start_equity", 0)
+        if history_status and isinstance(history_status[0].get("parsed"), dict):
+            p = history_status[0]["parsed"]
+            account = norm_str(p.get("account"))
+            current_equity   = p.get("equity", 0)
+            day_start_equity = p.get("day_start_equity", 0)
         if account:
             allowed, msg, status_type = check_risk_status(account, current_equity, day_start_equity)
             if not allowed:
@@ -1762,11 +1914,9 @@ def submit_order_v1():
             "action": "quote",
             "account": ""
         }
-        with history_lock:
-            if history_status and isinstance(history_status[0].get("parsed"), dict):
-                cmd["account"] = norm_str(history_status[0]["parsed"].get("account"))
-        with commands_lock:
-            commands.append(cmd)
+        if history_status and isinstance(history_status[0].get("parsed"), dict):
+            cmd["account"] = norm_str(history_status[0]["parsed"].get("account"))
+        commands.append(cmd)
         return jsonify({"success": True, "message": "报价请求已发送", "order": cmd})
 
     # ★ FIX #3 lots 计算：直接用前端传的 lots，不依赖断裂的 marginPct 路径
@@ -1792,13 +1942,12 @@ def submit_order_v1():
 
     # 填充 account
     account = ""
-    with history_lock:
-        if history_status and isinstance(history_status[0].get("parsed"), dict):
-            account = norm_str(history_status[0]["parsed"].get("account"))
-        if not account and history_report:
-            for rep in history_report:
-                if rep.get("parsed") and rep["parsed"].get("account"):
-                    account = norm_str(rep["parsed"].get("account")); break
+    if history_status and isinstance(history_status[0].get("parsed"), dict):
+        account = norm_str(history_status[0]["parsed"].get("account"))
+    if not account and history_report:
+        for rep in list(history_report):
+            if rep.get("parsed") and rep["parsed"].get("account"):
+                account = norm_str(rep["parsed"].get("account")); break
     cmd["account"] = account
 
     # ★ FIX #1: 平仓命令 — 不设 side="close"，只靠 action="close" 让 EA 识别
@@ -1841,10 +1990,9 @@ def submit_order_v1():
     if tp > 0: cmd["tp"] = tp
     if sl > 0: cmd["sl"] = sl
 
-    with commands_lock:
-        commands.append(cmd)
+    commands.append(cmd)
 
-    print(f"[ORDER][QUEUE] {json.dumps(cmd, ensure_ascii=False)}")
+    log.info("[ORDER][QUEUE] %s", cmd)
     return jsonify({"success": True, "message": "指令已发送到队列", "order": cmd})
 
 
@@ -1872,12 +2020,10 @@ def modify_position_v1():
         "created_at": int(time.time()), "ttl_sec": 60,
         "action": "modify", "ticket": ticket_int, "tp": tp, "sl": sl
     }
-    with history_lock:
-        if history_status and isinstance(history_status[0].get("parsed"), dict):
-            acc = norm_str(history_status[0]["parsed"].get("account"))
-            if acc: cmd["account"] = acc
-    with commands_lock:
-        commands.append(cmd)
+    if history_status and isinstance(history_status[0].get("parsed"), dict):
+        acc = norm_str(history_status[0]["parsed"].get("account"))
+        if acc: cmd["account"] = acc
+    commands.append(cmd)
     return jsonify({"success": True, "message": "修改指令已发送"})
 
 
@@ -1886,11 +2032,10 @@ def lock_position_v1():
     data = request.json
     position_id = data.get('positionId')
     target_pos = None
-    with history_lock:
-        if history_positions and history_positions[0].get("parsed"):
-            for p in history_positions[0]["parsed"].get("positions", []):
-                if str(p.get("ticket")) == str(position_id):
-                    target_pos = p; break
+    if history_positions and history_positions[0].get("parsed"):
+        for p in history_positions[0]["parsed"].get("positions", []):
+            if str(p.get("ticket")) == str(position_id):
+                target_pos = p; break
     if not target_pos:
         return jsonify({"success": False, "message": "未找到持仓，无法锁仓"}), 404
     with risk_lock:
@@ -1905,102 +2050,130 @@ def get_calendar_pnl_v1():
     with daily_stats_lock:
         stats = load_daily_stats()
     prefix = f"{year}-{month:02d}"
-    return jsonify({int(k.split('-')[2]): v for k, v in stats.items() if k.startswith(prefix)})
+    return orjson_response({int(k.split('-')[2]): v for k, v in stats.items() if k.startswith(prefix)})
 
 # ==================== MT4 接口 ====================
+TEXT_HEADERS     = {"Content-Type": "text/plain; charset=utf-8"}
+_NOCMD_RESPONSE  = ("NOCOMMAND", 200, TEXT_HEADERS)
+
+def format_command(cmd):
+    """echo 接口的纯文本命令行：side,symbol,volume[,sl,tp]"""
+    base = f"{cmd.get('side','')},{cmd.get('symbol','')},{cmd.get('volume','')}"
+    sl = cmd.get("sl_price"); tp = cmd.get("tp_price")
+    if not (sl or tp): return base
+    return f"{base},{sl or 0},{tp or 0}"
+
 @app.route("/web/api/echo", methods=["POST"])
 def mt4_webhook_echo():
-    raw_body = request.get_data(as_text=True)
-    store_mt4_data(raw_body, get_client_ip(), dict(request.headers))
-    lines = []
-    with commands_lock:
-        for cmd in commands:
-            side=cmd.get("side",""); symbol=cmd.get("symbol",""); volume=cmd.get("volume","")
-            base=f"{side},{symbol},{volume}"
-            sl=cmd.get("sl_price"); tp=cmd.get("tp_price")
-            if sl and tp: lines.append(f"{base},{sl},{tp}")
-            elif sl:      lines.append(f"{base},{sl},0")
-            elif tp:      lines.append(f"{base},0,{tp}")
-            else:         lines.append(base)
-        commands.clear()
-    if lines: return "\n".join(lines), 200, {"Content-Type": "text/plain; charset=utf-8"}
-    return "NOCOMMAND", 200, {"Content-Type": "text/plain; charset=utf-8"}
+    raw_bytes = request.get_data(cache=False)
+    store_mt4_data(raw_bytes, get_client_ip(), get_stored_headers())
+    drained = []
+    while True:
+        try: drained.append(commands.popleft())
+        except IndexError: break
+    if not drained: return _NOCMD_RESPONSE
+    return "\n".join(map(format_command, drained)), 200, TEXT_HEADERS
 
 @app.route("/web/api/mt4/commands", methods=["POST"])
 def mt4_commands():
     if is_restricted_time():
         return jsonify({"commands": [], "paused": paused}), 200
-    raw_body = request.get_data(as_text=True)
-    parsed_json, _ = store_mt4_data(raw_body, get_client_ip(), dict(request.headers))
+    raw_bytes = request.get_data(cache=False)
+    parsed_json, _ = store_mt4_data(raw_bytes, get_client_ip(), get_stored_headers())
     if parsed_json is None:
         return jsonify({"error": "Invalid JSON", "commands": []}), 400
     account = norm_str(parsed_json.get("account") if isinstance(parsed_json, dict) else None)
-    with commands_lock:
-        out = []; rem = []
-        for cmd in commands:
-            ca = norm_str(cmd.get("account"))
-            if not account or not ca or ca == account: out.append(cmd)
-            else: rem.append(cmd)
-        commands[:] = rem
-    print("[SEND CMDS]:", json.dumps(out, ensure_ascii=False))
+    out = []
+    for cmd in list(commands):
+        ca = norm_str(cmd.get("account"))
+        if (not account or not ca or ca == account) and take_command(cmd):
+            out.append(cmd)
+    if out: log.info("[SEND CMDS]: %s", out)
     with pause_lock: cp = paused
     return jsonify({"commands": out, "paused": cp}), 200
 
 @app.route("/api/pending_commands", methods=["GET"])
 def api_pending_commands():
-    with commands_lock:
-        return jsonify({"commands": [c for c in commands if c.get("action") != "quote"]})
+    return orjson_response({"commands": [c for c in list(commands) if c.get("action") != "quote"]})
 
 @app.route("/web/api/mt4/status", methods=["POST"])
 def mt4_status():
-    raw_body = request.get_data(as_text=True)
-    _, record = store_mt4_data(raw_body, get_client_ip(), dict(request.headers))
+    raw_bytes = request.get_data(cache=False)
+    _, record = store_mt4_data(raw_bytes, get_client_ip(), get_stored_headers())
     update_daily_stats_from_record(record)
     return "OK", 200
 
 @app.route("/web/api/mt4/positions", methods=["POST"])
 def mt4_positions():
-    store_mt4_data(request.get_data(as_text=True), get_client_ip(), dict(request.headers))
+    store_mt4_data(request.get_data(cache=False), get_client_ip(), get_stored_headers())
     return "OK", 200
 
 @app.route("/web/api/mt4/report", methods=["POST"])
 def mt4_report():
-    store_mt4_data(request.get_data(as_text=True), get_client_ip(), dict(request.headers))
+    store_mt4_data(request.get_data(cache=False), get_client_ip(), get_stored_headers())
     return "OK", 200
 
 @app.route("/web/api/mt4/quote", methods=["POST"])
 def mt4_quote():
-    store_mt4_data(request.get_data(as_text=True), get_client_ip(), dict(request.headers))
+    store_mt4_data(request.get_data(cache=False), get_client_ip(), get_stored_headers())
     return "OK", 200
 
+if msgspec is not None:
+    class Tick(msgspec.Struct):
+        symbol:    Optional[str]   = None
+        bid:       Optional[float] = None
+        ask:       Optional[float] = None
+        spread:    Any             = None   # spread / tick_time 原样透传，不做校验
+        tick_time: Any             = None   # （ts 按 EA 原值回显；换算毫秒时 receive_tick 再 float()）
+
+    # strict=False：兼容 EA 把数字当字符串发送
+    _tick_decoder = msgspec.json.Decoder(Union[List[Tick], Tick], strict=False)
+else:
+    _tick_decoder = None
+
+def decode_ticks(raw_bytes: bytes):
+    """解析 /api/tick 请求体（单个或数组），返回 (symbol, bid, ask, spread, tick_time) 列表"""
+    if _tick_decoder is not None:
+        try:
+            ticks = _tick_decoder.decode(raw_bytes)
+            if not isinstance(ticks, list): ticks = [ticks]
+        except msgspec.ValidationError:
+            # 个别 tick 字段非法：逐条转换并跳过坏的那条，不连累整批
+            items = msgspec.json.decode(raw_bytes)
+            if not isinstance(items, list): items = [items]
+            ticks = []
+            for item in items:
+                try: ticks.append(msgspec.convert(item, Tick, strict=False))
+                except msgspec.ValidationError: continue
+        return [(t.symbol, t.bid, t.ask, t.spread, t.tick_time) for t in ticks]
+    ticks = json.loads(raw_bytes)
+    if not isinstance(ticks, list): ticks = [ticks]
+    return [(t.get('symbol'), _to_float(t.get('bid')), _to_float(t.get('ask')),
+             t.get('spread'), t.get('tick_time')) for t in ticks]
+
 @app.route('/api/tick', methods=['POST'])
 def receive_tick():
     try:
-        ticks = request.json
-        if not isinstance(ticks, list): ticks = [ticks]
-        for tick in ticks:
-            symbol = tick.get('symbol'); bid = tick.get('bid'); ask = tick.get('ask')
-            tick_time = tick.get('tick_time')
-            if not symbol or bid is None or ask is None: continue
-            bf, af = _to_float(bid), _to_float(ask)
-            if bf is None or af is None: continue
+        for symbol, bf, af, spread, tick_time in decode_ticks(request.get_data(cache=False)):
+            if not symbol or bf is None or af is None: continue
             if tick_time is not None:
-                tft = float(tick_time); ts_ms = int(tft) if tft > 1e12 else int(tft * 1000)
+                tft = _to_float(tick_time)
+                if tft is None: continue
+                ts_ms = int(tft) if tft > 1e12 else int(tft * 1000)
             else:
                 ts_ms = int(time.time() * 1000)
-            cache_tick_quote(symbol, bf, af, spread=tick.get('spread'), ts=tick_time)
+            cache_tick_quote(symbol, bf, af, spread=spread, ts=tick_time)
             update_kline(symbol, bf, af, ts_ms)
-            with history_lock:
-                history_report.appendleft({
-                    "received_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "ip": get_client_ip(), "method": "POST", "path": "/api/tick",
-                    "category": "report", "headers": {}, "body_raw": json.dumps(tick),
-                    "parsed": {
-                        "desc": "QUOTE_DATA", "spread": tick.get('spread', 0),
-                        "ts": tick_time, "message": json.dumps({"bid": bf, "ask": af}),
-                        "symbol": symbol, "account": "tick_stream",
-                    }
-                })
+            push_history("report", {
+                "received_at": now_str(),
+                "ip": get_client_ip(), "method": "POST", "path": "/api/tick",
+                "category": "report", "headers": {},
+                "parsed": {
+                    "desc": "QUOTE_DATA", "spread": spread if spread is not None else 0,
+                    "ts": tick_time, "message": json.dumps({"bid": bf, "ask": af}),
+                    "symbol": symbol, "account": "tick_stream",
+                }
+            })
         return '', 204
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -2030,9 +2203,8 @@ def send_command():
         return redirect(url_for("index"))
 
     if not account:
-        with history_lock:
-            if history_status and isinstance(history_status[0].get("parsed"),dict):
-                account = norm_str(history_status[0]["parsed"].get("account"))
+        if history_status and isinstance(history_status[0].get("parsed"),dict):
+            account = norm_str(history_status[0]["parsed"].get("account"))
 
     now = int(time.time())
     cmd = {"id": generate_unique_cmd_id(), "nonce": generate_nonce(), "created_at": now, "ttl_sec": 10}
@@ -2050,21 +2222,24 @@ def send_command():
         cmd.update({"action":"close","ticket":int(ticket)})
         if lots and lots>0: cmd["lots"]=lots; cmd["volume"]=lots
 
-    with commands_lock: commands.append(cmd)
+    commands.append(cmd)
     return redirect(url_for("index"))
 
 @app.route("/delete_command/<int:index>", methods=["POST"])
 def delete_command(index):
-    with commands_lock:
-        if 0 <= index < len(commands): commands.pop(index)
+    if index >= 0:
+        try: del commands[index]
+        except IndexError: pass
     return redirect(url_for("index"))
 
 @app.route("/clear_commands", methods=["POST"])
 def clear_commands():
-    with commands_lock: commands.clear()
+    commands.clear()
     return redirect(url_for("index"))
 
 # ==================== 启动 ====================
+# ★ 生产环境走 Procfile: gunicorn -k gthread -w 1 --threads 8（状态在进程内，只能单 worker）
+# ★ 以下仅供本地调试
 # ★ threaded=True 解决 EA 轮询阻塞 UI 的 5s 延迟
 # ★ debug=False   关闭单线程 reloader，必须配合 threaded=True
 if __name__ == "__main__":